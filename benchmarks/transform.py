@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import random
+import string
+import argparse
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from models.models import TABLES, Liaufa, transform_ts
+from configs import TIMESTAMP_FORMAT
+
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+SIZES = [10000, 100000]
+NULL_RATE = 0.1
+THRESHOLD = 0.2
+# Timings keep the fastest of REPEAT runs, like timeit, to damp machine noise
+REPEAT = 5
+
+
+def _timestamp(rand):
+    ts = datetime(2021, 1, 1, tzinfo=timezone.utc) + timedelta(
+        seconds=rand.randrange(3 * 365 * 86400)
+    )
+    return ts.strftime(TIMESTAMP_FORMAT)
+
+
+def _value(field, rand, i):
+    type_ = field["type"].upper()
+    if field["name"] == "id":
+        return i
+    elif type_ == "RECORD":
+        if rand.random() < NULL_RATE:
+            return None
+        return {
+            sub["name"]: _value(sub, rand, rand.randrange(1, 10 ** 7))
+            for sub in field["fields"]
+        }
+    elif type_ == "TIMESTAMP":
+        return None if rand.random() < NULL_RATE else _timestamp(rand)
+    elif type_ == "DATE":
+        return _timestamp(rand)[:10]
+    elif type_ == "INTEGER":
+        return rand.randrange(10 ** 7)
+    elif type_ == "BOOLEAN":
+        return rand.random() < 0.5
+    else:
+        return "".join(rand.choices(string.ascii_letters, k=rand.randrange(4, 32)))
+
+
+def generate(model, n, seed=0):
+    rand = random.Random(seed)
+    return [
+        {field["name"]: _value(field, rand, i) for field in model.schema}
+        for i in range(1, n + 1)
+    ]
+
+
+def _measure(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def _peak(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench(table, n, repeat=REPEAT):
+    model = Liaufa.factory(table)
+    rows = generate(model, n)
+    timestamps = [
+        row[field["name"]]
+        for row in rows
+        for field in model.schema
+        if field["type"] == "TIMESTAMP"
+    ]
+    transformed, transform = _measure(lambda: model._transform(rows), repeat)
+    _, ts = _measure(lambda: [transform_ts(x) for x in timestamps], repeat)
+    # Mirrors the newline-delimited encoding done by load_table_from_json
+    _, serialize = _measure(
+        lambda: "\n".join(json.dumps(row, ensure_ascii=False) for row in transformed),
+        repeat,
+    )
+    return {
+        "transform": transform,
+        "transform_ts": ts,
+        "serialize": serialize,
+        "peak_mib": _peak(lambda: model._transform(rows)) / 2 ** 20,
+    }
+
+
+def compare(results, baselines, threshold):
+    regressions = []
+    for key, metrics in results.items():
+        for metric, value in metrics.items():
+            baseline = baselines.get(key, {}).get(metric)
+            if baseline and value > baseline * (1 + threshold):
+                regressions.append(f"{key} {metric}: {value:.4f} > {baseline:.4f}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tables",
+        nargs="+",
+        default=[table for i in TABLES.values() for table in i],
+    )
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--save", action="store_true")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for table in args.tables:
+        for n in args.sizes:
+            key = f"{table}/{n}"
+            results[key] = bench(table, n, args.repeat)
+            print(key, json.dumps({k: round(v, 4) for k, v in results[key].items()}))
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+    if args.save:
+        with open(BASELINES, "w") as f:
+            json.dump({**baselines, **results}, f, indent=4, sort_keys=True)
+        return 0
+    missing = [key for key in results if key not in baselines]
+    for key in missing:
+        print("NO BASELINE", key, "(run with --save to record one)")
+    regressions = compare(results, baselines, args.threshold)
+    for regression in regressions:
+        print("REGRESSION", regression)
+    return 1 if regressions or missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
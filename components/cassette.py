@@ -0,0 +1,218 @@
+import os
+import json
+import gzip
+import time
+import asyncio
+from collections import defaultdict, deque
+
+import requests
+
+CASSETTE_DIR = os.getenv("CASSETTE_DIR", "/tmp/cassettes")
+REPLAY_TOKEN = {"access": "replay"}
+
+
+def _key(method, url, params):
+    return json.dumps(
+        [method, url, {k: str(v) for k, v in (params or {}).items()}],
+        sort_keys=True,
+    )
+
+
+class CassetteResponse:
+    def __init__(self, entry):
+        self.status_code = entry["status"]
+        self.content = entry["body"].encode()
+        self.url = entry["url"]
+
+    @property
+    def status(self):
+        return self.status_code
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} for {self.url}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class AsyncCassetteResponse(CassetteResponse):
+    async def json(self):
+        return super().json()
+
+    async def read(self):
+        return self.content
+
+
+class _AsyncCall:
+    def __init__(self, cassette, session, method, url, kwargs):
+        self.cassette = cassette
+        self.session = session
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self._cm = None
+
+    async def __aenter__(self):
+        params = self.kwargs.get("params")
+        if self.cassette.mode == "replay":
+            if self.method == "post":
+                return AsyncCassetteResponse(self.cassette._token(self.url))
+            entry = self.cassette._next(self.method, self.url, params)
+            await asyncio.sleep(self.cassette._delay(entry))
+            return AsyncCassetteResponse(entry)
+        start = time.perf_counter()
+        self._cm = getattr(self.session, self.method)(self.url, **self.kwargs)
+        r = await self._cm.__aenter__()
+        body = await r.read()
+        if self.method == "get":
+            self.cassette._record(
+                self.method,
+                self.url,
+                params,
+                r.status,
+                body,
+                time.perf_counter() - start,
+            )
+        return r
+
+    async def __aexit__(self, *exc):
+        if self._cm:
+            return await self._cm.__aexit__(*exc)
+        return False
+
+
+class AsyncCassetteSession:
+    def __init__(self, cassette, session):
+        self.cassette = cassette
+        self.session = session
+
+    def get(self, url, **kwargs):
+        return _AsyncCall(self.cassette, self.session, "get", url, kwargs)
+
+    def post(self, url, **kwargs):
+        return _AsyncCall(self.cassette, self.session, "post", url, kwargs)
+
+
+class Cassette:
+    def __init__(self, name, mode, speed=1.0):
+        if mode not in ("record", "replay"):
+            raise ValueError(mode)
+        self.mode = mode
+        self.speed = float(speed)
+        self.path = os.path.join(CASSETTE_DIR, f"{name}.jsonl.gz")
+        self.session = None
+        self._entries = []
+        self._memos = {}
+        self._replay = defaultdict(deque)
+        if mode == "replay":
+            self._load()
+
+    def __enter__(self):
+        if self.mode == "record":
+            self.session = requests.Session()
+        return self
+
+    def __exit__(self, *exc):
+        if self.session:
+            self.session.close()
+        if self.mode == "record":
+            self._dump()
+        return False
+
+    def _load(self):
+        with gzip.open(self.path, "rt") as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["kind"] == "memo":
+                    self._memos[entry["key"]] = entry["value"]
+                else:
+                    key = _key(entry["method"], entry["url"], entry["params"])
+                    self._replay[key].append(entry)
+
+    def _dump(self):
+        os.makedirs(CASSETTE_DIR, exist_ok=True)
+        with gzip.open(self.path, "wt") as f:
+            for entry in self._entries:
+                f.write(json.dumps(entry) + "\n")
+
+    def _record(self, method, url, params, status, body, elapsed):
+        self._entries.append(
+            {
+                "kind": "http",
+                "method": method,
+                "url": url,
+                "params": {k: str(v) for k, v in (params or {}).items()},
+                "status": status,
+                "body": body.decode(),
+                "elapsed": elapsed,
+            }
+        )
+
+    def _next(self, method, url, params):
+        entries = self._replay.get(_key(method, url, params))
+        if not entries:
+            raise KeyError(f"Not in cassette: {method.upper()} {url} {params}")
+        # Keep the last recorded response so repeated requests stay servable
+        return entries.popleft() if len(entries) > 1 else entries[0]
+
+    def _delay(self, entry):
+        return entry["elapsed"] / self.speed if self.speed else 0
+
+    def _token(self, url):
+        return {
+            "status": 200,
+            "body": json.dumps(REPLAY_TOKEN),
+            "url": url,
+        }
+
+    def get(self, url, params=None, **kwargs):
+        if self.mode == "replay":
+            entry = self._next("get", url, params)
+            time.sleep(self._delay(entry))
+            return CassetteResponse(entry)
+        start = time.perf_counter()
+        r = self.session.get(url, params=params, **kwargs)
+        self._record(
+            "get",
+            url,
+            params,
+            r.status_code,
+            r.content,
+            time.perf_counter() - start,
+        )
+        return r
+
+    def post(self, url, **kwargs):
+        # Token calls are never written to the cassette
+        if self.mode == "replay":
+            return CassetteResponse(self._token(url))
+        return self.session.post(url, **kwargs)
+
+    def wrap_async(self, session):
+        return AsyncCassetteSession(self, session)
+
+    def memo(self, key, fn, dump=lambda x: x, load=lambda x: x):
+        if self.mode == "replay":
+            return load(self._memos[key])
+        value = fn()
+        self._entries.append(
+            {
+                "kind": "memo",
+                "key": key,
+                "value": dump(value),
+            }
+        )
+        return value
+
+
+def memo(session, key, fn, **kwargs):
+    if isinstance(session, Cassette):
+        return session.memo(key, fn, **kwargs)
+    return fn()
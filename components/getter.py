@@ -5,6 +5,9 @@ from abc import ABCMeta, abstractmethod
 from datetime import datetime
 import asyncio
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import aiohttp
@@ -13,18 +16,23 @@ from configs import (
     BASE_URL,
     CONTENT_TYPE,
     TIMESTAMP_FORMAT,
-    BQ_CLIENT,
-    DATASET,
     MIN_TIMESTAMP,
 )
+from components.cassette import Cassette, memo
+from components.idset import IdSet
+from components.sink import SINK
+
+KEYSET_RANGES = 8
+KEYSET_BUFFER = 4
+ID_PAGE_SIZE = 1000
 
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 
-def get_headers(attempt=0):
+def get_headers(session=requests, attempt=0):
     try:
-        with requests.post(
+        with session.post(
             url=f"{BASE_URL}/token/",
             params={
                 "h": "https://app.aicorns.com",
@@ -40,7 +48,7 @@ def get_headers(attempt=0):
             if r.status_code == 429:
                 if attempt < 5:
                     time.sleep(5)
-                    return get_headers(attempt + 1)
+                    return get_headers(session, attempt + 1)
                 elif attempt >= 5:
                     raise Exception("Too many attempts")
             elif r.status_code == 200:
@@ -53,7 +61,7 @@ def get_headers(attempt=0):
             else:
                 r.raise_for_status()
     except requests.exceptions.SSLError:
-        return get_headers(attempt + 1)
+        return get_headers(session, attempt + 1)
 
 
 async def get_headers_async(session):
@@ -88,37 +96,113 @@ class Getter(metaclass=ABCMeta):
     def __init__(self, model):
         self.endpoint = model.endpoint
         self.page_size = model.page_size
+        self.id_key = model.p_key[0]
+        self.url = f"{BASE_URL}/{self.endpoint}"
+        self.headers = None
+        self.drift = 0
+        self._seen = IdSet()
+        self._count = None
 
     @abstractmethod
-    def get(self):
+    def pages(self, session):
         pass
 
+    def get(self, session):
+        return [row for page in self.pages(session) for row in page]
+
+    def _get_page(self, session, page, **params):
+        while True:
+            self.headers = self.headers or get_headers(session)
+            with session.get(
+                self.url,
+                params={
+                    "page_size": self.page_size,
+                    "page": page,
+                    **params,
+                },
+                headers=self.headers,
+            ) as r:
+                if r.status_code == 404:
+                    return None
+                elif r.status_code == 401:
+                    self.headers = None
+                elif r.status_code == 200:
+                    return r.json()
+                else:
+                    r.raise_for_status()
+
+    def _get_count(self, session):
+        return self._get_page(session, 1, page_size=1)["count"]
+
+    def _track(self, session, page, res, step=1, **params):
+        # Offset pages shift when rows change mid-run: a changed count means
+        # rows may have slid over the boundary with the previous page
+        rows = res["results"]
+        count = res.get("count")
+        shifted = self._count is not None and count != self._count
+        self._count = count
+        if any(row[self.id_key] in self._seen for row in rows):
+            self.drift += 1
+        self._seen.update(row[self.id_key] for row in rows)
+        neighbor = page - step
+        if not shifted or neighbor < 1:
+            return rows
+        return self._refetch(session, neighbor, **params) + rows
+
+    def _track_end(self, session, page, skipped=0, **params):
+        # Deletions can also pull the last page away: a 404 while fewer rows
+        # than the last count were fetched means some slid onto the page before
+        if page < 2 or self._count is None or skipped + len(self._seen) >= self._count:
+            return []
+        return self._refetch(session, page - 1, **params)
+
+    def _refetch(self, session, page, **params):
+        self.drift += 1
+        res = self._get_page(session, page, **params)
+        missed = [
+            row
+            for row in (res or {}).get("results", [])
+            if row[self.id_key] not in self._seen
+        ]
+        self._seen.update(row[self.id_key] for row in missed)
+        return missed
+
 
 class SimpleGetter(Getter):
-    def get(self, session, headers=None, page=1):
-        headers = get_headers() if not headers else headers
-        print(page)
-        with session.get(
-            f"{BASE_URL}/{self.endpoint}",
-            params={
-                "page_size": self.page_size,
-                "page": page,
-            },
-            headers=headers,
-        ) as r:
-            if r.status_code == 404:
-                return []
-            elif r.status_code == 401:
-                return self.get(session, page=page)
-            elif r.status_code == 200:
-                res = r.json()
-                return res.get("results") + self.get(
-                    session,
-                    headers=headers,
-                    page=page + 1,
-                )
-            else:
-                r.raise_for_status()
+    def pages(self, session):
+        page = 1
+        while True:
+            print(page)
+            res = self._get_page(session, page)
+            if res is None:
+                yield self._track_end(session, page)
+                return
+            yield self._track(session, page, res)
+            page += 1
+
+
+class IdGetter(Getter):
+    def __init__(self, model):
+        super().__init__(model)
+        self.page_size = ID_PAGE_SIZE
+
+    def pages(self, session):
+        page = 1
+        while True:
+            res = self._get_page(session, page, fields=self.id_key)
+            if res is None:
+                return
+            self.drift += self._count is not None and res["count"] != self._count
+            self._count = res["count"]
+            yield [row[self.id_key] for row in res["results"]]
+            page += 1
+
+    def get(self, session):
+        ids = IdSet()
+        for page in self.pages(session):
+            ids.update(page)
+        self.complete = not self.drift and len(ids) == self._count
+        return ids
 
 
 class ReverseGetter(Getter):
@@ -127,65 +211,32 @@ class ReverseGetter(Getter):
         self.ordering_key = model.ordering_key
         self.table = model.table
 
-    def get(self, session):
-        url = f"{BASE_URL}/{self.endpoint}"
-        reverse_stop = self._get_reverse_stop()
-        headers = get_headers()
-        count = self._get_count(session, url, headers)
-        calls_needed = math.ceil(count / self.page_size)
-        return self._get(session, url, reverse_stop, calls_needed, headers)
-
-    def _get(self, session, url, reverse_stop, page, headers=None):
-        headers = get_headers() if not headers else headers
-        with session.get(
-            url,
-            params={
-                "page_size": self.page_size,
-                "page": page,
-                "ordering": self.ordering_key,
-            },
-            headers=headers,
-        ) as r:
-            if r.status_code == 404:
-                return []
-            elif r.status_code == 401:
-                time.sleep(5)
-                return self._get(session, page=page)
-            elif r.status_code == 200:
-                res = r.json()
-                _rows = res["results"]
-                if (
-                    datetime.strptime(
-                        _rows[-1][self.ordering_key],
-                        TIMESTAMP_FORMAT,
-                    )
-                    < reverse_stop
-                ):
-                    next_run = []
-                else:
-                    next_run = self._get(session, url, reverse_stop, page - 1, headers)
-                return res["results"] + next_run
-            else:
-                r.raise_for_status()
-
-    def _get_count(self, session, url, headers):
-        with session.get(
-            url,
-            params={
-                "page_size": 1,
-                "page": 1,
-            },
-            headers=headers,
-        ) as r:
-            res = r.json()
-        return res["count"]
+    def pages(self, session):
+        reverse_stop = memo(
+            session,
+            "reverse_stop",
+            self._get_reverse_stop,
+            dump=datetime.isoformat,
+            load=datetime.fromisoformat,
+        )
+        page = math.ceil(self._get_count(session) / self.page_size)
+        while page > 0:
+            res = self._get_page(session, page, ordering=self.ordering_key)
+            if res is None or not res["results"]:
+                return
+            yield self._track(session, page, res, -1, ordering=self.ordering_key)
+            if (
+                datetime.strptime(
+                    res["results"][-1][self.ordering_key],
+                    TIMESTAMP_FORMAT,
+                )
+                < reverse_stop
+            ):
+                return
+            page -= 1
 
     def _get_reverse_stop(self):
-        query = f"""
-        SELECT MAX({self.ordering_key}) AS max_incre
-        FROM {DATASET}.{self.table}"""
-        rows = BQ_CLIENT.query(query).result()
-        result = [dict(row.items()) for row in rows][0]["max_incre"]
+        result = SINK.watermark(self.table, self.ordering_key)
         return result if result else MIN_TIMESTAMP
 
 
@@ -195,42 +246,97 @@ class DeltaGetter(Getter):
         self.p_key = model.p_key
         self.table = model.table
 
-    def get(self, session):
-        current_rows = self._get_current_rows()
-        starting_page = math.floor(current_rows / self.page_size)
-        return self._get(session, starting_page)
-
-    def _get(self, session, page, headers=None):
-        headers = get_headers() if not headers else headers
-        with session.get(
-            f"{BASE_URL}/{self.endpoint}",
-            params={
-                "page_size": self.page_size,
-                "page": page,
-            },
-            headers=headers,
-        ) as r:
-            if r.status_code == 404:
-                return []
-            elif r.status_code == 401:
-                return self._get(session, page=page)
-            elif r.status_code == 200:
-                res = r.json()
-                return res.get("results") + self._get(
-                    session,
-                    headers=headers,
-                    page=page + 1,
+    def pages(self, session):
+        current_rows = memo(session, "current_rows", self._get_current_rows)
+        start = max(math.floor(current_rows / self.page_size), 1)
+        page = start
+        while True:
+            res = self._get_page(session, page)
+            if res is None:
+                yield self._track_end(
+                    session, page, skipped=(start - 1) * self.page_size
                 )
-            else:
-                r.raise_for_status()
+                return
+            yield self._track(session, page, res)
+            page += 1
 
     def _get_current_rows(self):
-        query = f"""
-        SELECT COUNT(*) AS cnt
-        FROM {DATASET}.{self.table}"""
-        rows = BQ_CLIENT.query(query).result()
-        result = [dict(row.items()) for row in rows][0]["cnt"]
-        return result
+        return SINK.count(self.table)
+
+
+class KeysetGetter(SimpleGetter):
+    def __init__(self, model):
+        super().__init__(model)
+        self.keyset_key = model.keyset_key
+        self.table = model.table
+
+    def pages(self, session):
+        key = self.keyset_key
+        last = self._get_page(session, 1, page_size=1, ordering=f"-{key}")
+        hi = last["results"][0][key] if last and last["results"] else None
+        probe = hi is not None and self._get_page(
+            session, 1, page_size=1, **{f"{key}__gt": hi}
+        )
+        if hi is None or (probe and probe["results"]):
+            # Filters are ignored by this endpoint, fall back to offset paging
+            yield from super().pages(session)
+            return
+        lo = memo(session, "keyset_start", self._get_keyset_start) or 0
+        step = KEYSET_RANGES
+        bounds = [lo + (hi - lo) * i // step for i in range(step + 1)]
+        ranges = [(bounds[i], bounds[i + 1]) for i in range(step)]
+        # Ranges fetch concurrently into bounded queues that are drained in key
+        # order, so pages stream out without holding whole ranges in memory
+        queues = [queue.Queue(maxsize=KEYSET_BUFFER) for _ in ranges]
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            for q, (_lo, _hi) in zip(queues, ranges):
+                executor.submit(self._get_range, session, _lo, _hi, q, stop)
+            try:
+                for q in queues:
+                    while True:
+                        page = q.get()
+                        if page is None:
+                            break
+                        elif isinstance(page, Exception):
+                            raise page
+                        yield page
+            finally:
+                stop.set()
+
+    def _put(self, q, item, stop):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get_range(self, session, lo, hi, q, stop):
+        key = self.keyset_key
+        try:
+            while lo < hi:
+                res = self._get_page(
+                    session,
+                    1,
+                    ordering=key,
+                    **{f"{key}__gt": lo, f"{key}__lte": hi},
+                )
+                if res is None or not res["results"]:
+                    break
+                if not self._put(q, res["results"], stop):
+                    return
+                if len(res["results"]) < self.page_size:
+                    break
+                lo = res["results"][-1][key]
+        except Exception as e:
+            self._put(q, e, stop)
+            return
+        self._put(q, None, stop)
+
+    def _get_keyset_start(self):
+        return SINK.watermark(self.table, self.keyset_key)
 
 
 class AsyncGetter(Getter):
@@ -238,32 +344,32 @@ class AsyncGetter(Getter):
         super().__init__(model)
         self.ordering_key = model.ordering_key
 
-    def get(self, session):
-        url = f"{BASE_URL}/{self.endpoint}"
+    def pages(self, session):
+        url = self.url
+        headers = get_headers(session)
 
         async def get_async():
             connector = aiohttp.TCPConnector(limit=10)
             timeout = aiohttp.ClientTimeout(total=3600)
             async with aiohttp.ClientSession(
                 connector=connector, timeout=timeout
-            ) as session:
-                headers = get_headers()
-                count = await self._get_count(session, url, headers)
+            ) as client:
+                _session = (
+                    session.wrap_async(client)
+                    if isinstance(session, Cassette)
+                    else client
+                )
+                count = await self._get_count_async(_session, url, headers)
                 calls_needed = math.ceil(count / self.page_size)
                 tasks = [
-                    asyncio.create_task(self._get_one(session, url, headers, i))
-                    # for i in range(1, calls_needed + 1)
-                    for i in range(900, 960)
-                    # for i in range(1, calls_needed + 1)
-                    # for i in range(1, calls_needed + 1)
-                    # for i in range(1, calls_needed + 1)
+                    asyncio.create_task(self._get_one(_session, url, headers, i))
+                    for i in range(1, calls_needed + 1)
                 ]
-                rows = await asyncio.gather(*tasks)
-                return [i for j in rows for i in j]
+                return await asyncio.gather(*tasks)
 
-        return asyncio.run(get_async())
+        yield from asyncio.run(get_async())
 
-    async def _get_count(self, session, url, headers):
+    async def _get_count_async(self, session, url, headers):
         async with session.get(
             url,
             params={
@@ -302,3 +408,30 @@ class AsyncGetter(Getter):
                 else:
                     res = await r.json()
                     return res["results"]
+
+
+FULL_FETCH_PAGES = 50
+
+
+def select_getter(model, session):
+    if model.getter:
+        return model.getter, "pinned"
+    stored_rows = memo(session, "stored_rows", lambda: SINK.count(model.table))
+    if stored_rows and getattr(model, "incre_key", None) and model.ordering_key:
+        return (
+            ReverseGetter,
+            f"{stored_rows} stored, incremental on {model.ordering_key}",
+        )
+    elif stored_rows and model.keyset_key:
+        return KeysetGetter, f"{stored_rows} stored, keyset on {model.keyset_key}"
+    count = SimpleGetter(model)._get_count(session)
+    pages = math.ceil(count / model.page_size)
+    if pages <= FULL_FETCH_PAGES:
+        return SimpleGetter, f"{pages} pages <= {FULL_FETCH_PAGES}, full fetch"
+    elif not stored_rows and model.keyset_key:
+        return KeysetGetter, f"{pages} pages, empty table, keyset backfill"
+    elif not stored_rows:
+        return AsyncGetter, f"{pages} pages, empty table, async backfill"
+    else:
+        # Stored rows may have changed and there is no key to find them by
+        return SimpleGetter, f"{pages} pages, no incremental key, full fetch"
@@ -0,0 +1,31 @@
+class IdSet:
+    def __init__(self, ids=()):
+        self._bits = bytearray()
+        self._len = 0
+        self.update(ids)
+
+    def add(self, i):
+        byte, bit = divmod(i, 8)
+        if byte >= len(self._bits):
+            self._bits.extend(bytes(max(byte + 1 - len(self._bits), len(self._bits))))
+        if not self._bits[byte] & (1 << bit):
+            self._bits[byte] |= 1 << bit
+            self._len += 1
+
+    def update(self, ids):
+        for i in ids:
+            self.add(i)
+
+    def __contains__(self, i):
+        byte, bit = divmod(i, 8)
+        return byte < len(self._bits) and bool(self._bits[byte] & (1 << bit))
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for byte, value in enumerate(self._bits):
+            if value:
+                for bit in range(8):
+                    if value & (1 << bit):
+                        yield byte * 8 + bit
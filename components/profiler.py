@@ -0,0 +1,75 @@
+import os
+import io
+import cProfile
+import pstats
+import tracemalloc
+from datetime import datetime
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+TOP_N = 30
+
+
+def _artifact(name, mode, ext):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    ts = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    return os.path.join(PROFILE_DIR, f"{name}-{mode}-{ts}.{ext}")
+
+
+def _profile_cpu(fn, name):
+    profiler = cProfile.Profile()
+    result = profiler.runcall(fn)
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats("cumulative").print_stats(TOP_N)
+    stats.sort_stats("tottime").print_stats(TOP_N)
+    stats.dump_stats(_artifact(name, "cpu", "prof"))
+    return result, stream.getvalue()
+
+
+def _profile_alloc(fn, name):
+    tracemalloc.start(25)
+    try:
+        result = fn()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    snapshot = snapshot.filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ]
+    )
+    lines = [
+        f"current={current / 2**20:.1f}MiB peak={peak / 2**20:.1f}MiB",
+        f"Top {TOP_N} allocation sites:",
+    ]
+    for stat in snapshot.statistics("lineno")[:TOP_N]:
+        lines.append(str(stat))
+    lines.append(f"Top {TOP_N} allocation tracebacks:")
+    for stat in snapshot.statistics("traceback")[:TOP_N]:
+        lines.append(f"{stat.size / 2**10:.1f}KiB in {stat.count} blocks")
+        lines.extend(f"    {line}" for line in stat.traceback.format())
+    return result, "\n".join(lines)
+
+
+PROFILERS = {
+    "cpu": _profile_cpu,
+    "alloc": _profile_alloc,
+}
+
+
+def profile(mode, fn, name):
+    try:
+        profiler = PROFILERS[mode]
+    except KeyError:
+        raise ValueError(mode)
+    response, report = profiler(fn, name)
+    print(report)
+    path = _artifact(name, mode, "txt")
+    with open(path, "w") as f:
+        f.write(report)
+    return {
+        **response,
+        "profile": path,
+    }
@@ -0,0 +1,221 @@
+import json
+import sqlite3
+from abc import ABCMeta, abstractmethod
+from datetime import datetime
+
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+from configs import BQ_CLIENT, DATASET, SINK_BACKEND, SQLITE_PATH
+from components.idset import IdSet
+
+
+class Sink(metaclass=ABCMeta):
+    @abstractmethod
+    def append(self, table, rows, schema):
+        pass
+
+    @abstractmethod
+    def dedup(self, table, p_key, incre_key=None):
+        pass
+
+    @abstractmethod
+    def watermark(self, table, key):
+        pass
+
+    @abstractmethod
+    def count(self, table):
+        pass
+
+    @abstractmethod
+    def ids(self, table, key):
+        pass
+
+    @abstractmethod
+    def delete(self, table, key, ids):
+        pass
+
+
+class BigQuerySink(Sink):
+    def __init__(self, client, dataset):
+        self.client = client
+        self.dataset = dataset
+
+    def append(self, table, rows, schema):
+        return self.client.load_table_from_json(
+            rows,
+            f"{self.dataset}.{table}",
+            job_config=bigquery.LoadJobConfig(
+                create_disposition="CREATE_IF_NEEDED",
+                write_disposition="WRITE_APPEND",
+                schema=schema,
+            ),
+        )
+
+    def dedup(self, table, p_key, incre_key=None):
+        incre_key = f"ORDER BY {incre_key} DESC" if incre_key else ""
+        query = f"""
+        CREATE OR REPLACE TABLE {self.dataset}.{table} AS
+        SELECT * EXCEPT (row_num)
+        FROM (
+            SELECT
+                *,
+                ROW_NUMBER() OVER (PARTITION BY {','.join(p_key)} {incre_key}) AS row_num
+            FROM {self.dataset}.{table}
+        ) WHERE row_num = 1"""
+        self.client.query(query).result()
+
+    def watermark(self, table, key):
+        query = f"""
+        SELECT MAX({key}) AS max_key
+        FROM {self.dataset}.{table}"""
+        try:
+            rows = self.client.query(query).result()
+        except NotFound:
+            return None
+        return [dict(row.items()) for row in rows][0]["max_key"]
+
+    def count(self, table):
+        try:
+            return self.client.get_table(f"{self.dataset}.{table}").num_rows
+        except NotFound:
+            return 0
+
+    def ids(self, table, key):
+        query = f"""
+        SELECT {key} AS id
+        FROM {self.dataset}.{table}"""
+        return IdSet(row["id"] for row in self.client.query(query).result())
+
+    def delete(self, table, key, ids):
+        query = f"""
+        DELETE FROM {self.dataset}.{table}
+        WHERE {key} IN UNNEST(@ids)"""
+        self.client.query(
+            query,
+            job_config=bigquery.QueryJobConfig(
+                query_parameters=[
+                    bigquery.ArrayQueryParameter("ids", "INT64", ids),
+                ]
+            ),
+        ).result()
+
+
+class SQLiteResult:
+    def __init__(self, output_rows):
+        self.output_rows = output_rows
+
+    def result(self):
+        return self
+
+
+SQLITE_TYPES = {
+    "INTEGER": "INTEGER",
+    "FLOAT": "REAL",
+    "BOOLEAN": "INTEGER",
+}
+
+
+class SQLiteSink(Sink):
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        # Opened on first use so importing never creates the database file
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+        return self._conn
+
+    def _exists(self, table):
+        return self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (table,),
+        ).fetchone()
+
+    def append(self, table, rows, schema):
+        columns = [field["name"] for field in schema]
+        records = [
+            field["name"] for field in schema if field["type"].upper() == "RECORD"
+        ]
+        definitions = [
+            f"{field['name']} {SQLITE_TYPES.get(field['type'].upper(), 'TEXT')}"
+            for field in schema
+        ]
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(definitions)})"
+        )
+        with self.conn:
+            self.conn.executemany(
+                f"""INSERT INTO {table} ({', '.join(columns)})
+                VALUES ({', '.join('?' * len(columns))})""",
+                (
+                    tuple(
+                        json.dumps(row.get(column))
+                        if column in records
+                        else row.get(column)
+                        for column in columns
+                    )
+                    for row in rows
+                ),
+            )
+        return SQLiteResult(len(rows))
+
+    def dedup(self, table, p_key, incre_key=None):
+        incre_key = f"{incre_key} DESC, " if incre_key else ""
+        with self.conn:
+            self.conn.execute(
+                f"""
+                DELETE FROM {table}
+                WHERE rowid NOT IN (
+                    SELECT rowid FROM (
+                        SELECT
+                            rowid,
+                            ROW_NUMBER() OVER (
+                                PARTITION BY {','.join(p_key)}
+                                ORDER BY {incre_key}rowid DESC
+                            ) AS row_num
+                        FROM {table}
+                    ) WHERE row_num = 1
+                )"""
+            )
+
+    def watermark(self, table, key):
+        if not self._exists(table):
+            return None
+        value = self.conn.execute(f"SELECT MAX({key}) FROM {table}").fetchone()[0]
+        # Timestamps are stored as the ISO strings produced by transform_ts
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        return value
+
+    def count(self, table):
+        if not self._exists(table):
+            return 0
+        return self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def ids(self, table, key):
+        if not self._exists(table):
+            return IdSet()
+        rows = self.conn.execute(f"SELECT {key} FROM {table}")
+        return IdSet(row[0] for row in rows)
+
+    def delete(self, table, key, ids):
+        with self.conn:
+            self.conn.executemany(
+                f"DELETE FROM {table} WHERE {key} = ?",
+                ((i,) for i in ids),
+            )
+
+
+def get_sink(backend):
+    if backend == "bigquery":
+        return BigQuerySink(BQ_CLIENT, DATASET)
+    elif backend == "sqlite":
+        return SQLiteSink(SQLITE_PATH)
+    else:
+        raise ValueError(f"Unknown SINK {backend}, expected bigquery or sqlite")
+
+
+SINK = get_sink(SINK_BACKEND)
@@ -1,3 +1,4 @@
+import os
 from datetime import datetime, timezone
 
 from google.cloud import bigquery
@@ -10,6 +11,10 @@ CONTENT_TYPE = {
 NOW = datetime.utcnow()
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
 
-BQ_CLIENT = bigquery.Client()
+SINK_BACKEND = os.getenv("SINK", "bigquery")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "liaufa.db")
+
+BQ_CLIENT = bigquery.Client() if SINK_BACKEND == "bigquery" else None
 DATASET = "Liaufa"
 MIN_TIMESTAMP = datetime(2018, 1, 1, tzinfo=timezone.utc)
+RUNS_TABLE = "_runs"
@@ -1,5 +1,11 @@
+from functools import partial
+
 from models.models import Liaufa
 from tasks import create_task
+from components.profiler import profile
+
+RUN_OPTIONS = ["cassette", "speed", "derive"]
+TOMBSTONE_OPTIONS = ["cassette", "speed", "derive"]
 
 
 def main(request):
@@ -7,11 +13,23 @@ def main(request):
     print(data)
 
     if "tasks" in data:
-        response = create_task()
+        response = create_task(data.get("force", False))
     elif "table" in data:
-        response = Liaufa.factory(
-            data["table"],
-        ).run()
+        model = Liaufa.factory(data["table"])
+        if data.get("tombstone"):
+            run = partial(
+                model.tombstone,
+                **{k: data[k] for k in TOMBSTONE_OPTIONS if k in data},
+            )
+        else:
+            run = partial(
+                model.run,
+                **{k: data[k] for k in RUN_OPTIONS if k in data},
+            )
+        if data.get("profile"):
+            response = profile(data["profile"], run, data["table"])
+        else:
+            response = run()
     else:
         raise ValueError(data)
 
@@ -1,14 +1,14 @@
 from models.models import Liaufa, transform_ts
-from components.getter import SimpleGetter
 
 
 class CampaignContacts(Liaufa):
-    getter = SimpleGetter
     table = "campaign_contacts"
     endpoint = "campaign-contacts/"
     page_size = 10000
+    refresh_interval = 30
     p_key = ["id"]
     ordering_key = "updated"
+    incre_key = "updated"
 
     schema = [
         {"name": "id", "type": "INTEGER"},
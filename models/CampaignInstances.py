@@ -1,14 +1,14 @@
 from models.models import Liaufa, transform_ts
-from components.getter import SimpleGetter
 
 
 class CampaignInstances(Liaufa):
-    getter = SimpleGetter
     table = "campaign_instances"
     endpoint = "campaign-instances/"
     page_size = 1000
+    refresh_interval = 60
     p_key = ["id"]
-    ordering_key = ["updated"]
+    ordering_key = "updated"
+    incre_key = "updated"
 
     schema = [
         {"name": "id", "type": "INTEGER"},
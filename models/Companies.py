@@ -1,16 +1,16 @@
 import json
 
 from models.models import Liaufa, transform_ts
-from components.getter import SimpleGetter
 
 
 class Companies(Liaufa):
-    getter = SimpleGetter
     table = "companies"
     endpoint = "companies/"
     page_size = 100
+    refresh_interval = 360
     p_key = ["id"]
     ordering_key = "updated"
+    incre_key = "updated"
 
     schema = [
         {"name": "id", "type": "INTEGER"},
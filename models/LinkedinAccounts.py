@@ -1,12 +1,12 @@
 from models.models import Liaufa
-from components.getter import SimpleGetter
 
 
 class LinkedinAccounts(Liaufa):
-    getter = SimpleGetter
     table = "linkedin_accounts"
     endpoint = "linkedin/accounts/"
     page_size = 1000
+    refresh_interval = 360
+    parallel_transform_rows = None
     p_key = ["id"]
     ordering_key = "id"
 
@@ -1,15 +1,14 @@
 from models.models import Liaufa, transform_ts
-from components.getter import DeltaGetter, AsyncGetter
 
 
 class LinkedinContacts(Liaufa):
-    getter = DeltaGetter
-    # getter = AsyncGetter
     table = "linkedin_contacts"
     endpoint = "linkedin/contacts/"
     page_size = 100
+    refresh_interval = 30
     p_key = ["id"]
     ordering_key = "updated"
+    keyset_key = "id"
 
     schema = [
         {"name": "id", "type": "INTEGER"},
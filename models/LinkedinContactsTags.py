@@ -1,12 +1,12 @@
 from models.models import Liaufa
-from components.getter import SimpleGetter
 
 
 class LinkedinContactsTags(Liaufa):
-    getter = SimpleGetter
     table = "linkedin_contacts_tags"
     endpoint = "linkedin/contacts/tags/"
     page_size = 10
+    refresh_interval = 120
+    parallel_transform_rows = None
     p_key = ["id"]
     ordering_key = None
 
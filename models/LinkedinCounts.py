@@ -1,14 +1,14 @@
 from models.models import Liaufa, transform_ts
-from components.getter import SimpleGetter
 
 
 class LinkedinCounts(Liaufa):
-    getter = SimpleGetter
     table = "linkedin_counts"
     endpoint = "linkedin/counts/"
     page_size = 1000
+    refresh_interval = 60
     p_key = ["id"]
     ordering_key = "updated"
+    incre_key = "updated"
 
     schema = [
         {"name": "id", "type": "INTEGER"},
@@ -1,14 +1,13 @@
 from models.models import Liaufa, transform_ts
-from components.getter import ReverseGetter, AsyncGetter
 
 
 class LinkedinSimpleMessenger(Liaufa):
-    getter = ReverseGetter
-    # getter = AsyncGetter
     table = "linkedin_simple_messenger"
     endpoint = "linkedin/simple-messenger/"
     page_size = 100
+    refresh_interval = 15
     ordering_key = "updated"
+    keyset_key = "id"
     p_key = ["id"]
     incre_key = "updated"
 
@@ -1,14 +1,14 @@
 from models.models import Liaufa, transform_ts
-from components.getter import SimpleGetter
 
 
 class Tags(Liaufa):
-    getter = SimpleGetter
     table = "tags"
     endpoint = "tags/"
     page_size = 100
+    refresh_interval = 360
     p_key = ["id"]
     ordering_key = "updated"
+    incre_key = "updated"
 
     schema = [
         {"name": "id", "type": "INTEGER"},
@@ -0,0 +1,157 @@
+from google.cloud import bigquery
+
+from configs import BQ_CLIENT, DATASET, SINK_BACKEND
+
+# Keys per query, keeps the array parameter well under the request size limit
+DERIVE_BATCH = 10000
+
+DERIVED = {
+    "contacts_tags": {
+        "key": "contact_id",
+        "query": """
+        SELECT
+            c.id AS contact_id,
+            ANY_VALUE(c.name) AS name,
+            ANY_VALUE(c.company_name) AS company_name,
+            ANY_VALUE(c.email) AS email,
+            ARRAY_AGG(DISTINCT t.name IGNORE NULLS) AS tag_names,
+            MAX(c.updated) AS updated
+        FROM {dataset}.linkedin_contacts c
+        LEFT JOIN {dataset}.linkedin_contacts_tags ct ON ct.contact = c.id
+        LEFT JOIN {dataset}.tags t ON t.id = ct.tag
+        {where}
+        GROUP BY c.id""",
+        "where": "WHERE c.id IN UNNEST(_keys)",
+        "sources": {
+            "linkedin_contacts": """
+            SELECT id AS _key FROM UNNEST(@keys) AS id""",
+            "linkedin_contacts_tags": """
+            SELECT contact AS _key
+            FROM {dataset}.linkedin_contacts_tags
+            WHERE id IN UNNEST(@keys)""",
+            "tags": """
+            SELECT contact AS _key
+            FROM {dataset}.linkedin_contacts_tags
+            WHERE tag IN UNNEST(@keys)""",
+        },
+    },
+    "campaign_instances_stats": {
+        "key": "campaign_instance_id",
+        "query": """
+        SELECT
+            ci.id AS campaign_instance_id,
+            ANY_VALUE(ci.name) AS name,
+            ANY_VALUE(ci.active) AS active,
+            ANY_VALUE(ci.li_account) AS li_account,
+            COUNT(DISTINCT cc.contact) AS contacts,
+            ARRAY_AGG(
+                IF(
+                    m.id IS NULL,
+                    NULL,
+                    STRUCT(
+                        m.contact_status,
+                        m.conversation_status,
+                        m.updated
+                    )
+                )
+                IGNORE NULLS
+                ORDER BY m.updated DESC
+                LIMIT 1
+            )[SAFE_OFFSET(0)] AS latest_messenger
+        FROM {dataset}.campaign_instances ci
+        LEFT JOIN {dataset}.campaign_contacts cc
+            ON cc.campaign_instance = ci.id
+        LEFT JOIN {dataset}.linkedin_simple_messenger m
+            ON m.contact.id = cc.contact
+            AND m.li_account.id = ci.li_account
+        {where}
+        GROUP BY ci.id""",
+        "where": "WHERE ci.id IN UNNEST(_keys)",
+        "sources": {
+            "campaign_instances": """
+            SELECT id AS _key FROM UNNEST(@keys) AS id""",
+            "campaign_contacts": """
+            SELECT campaign_instance AS _key
+            FROM {dataset}.campaign_contacts
+            WHERE id IN UNNEST(@keys)""",
+            "linkedin_simple_messenger": """
+            SELECT cc.campaign_instance AS _key
+            FROM {dataset}.campaign_contacts cc
+            INNER JOIN {dataset}.linkedin_simple_messenger m
+                ON m.contact.id = cc.contact
+            WHERE m.id IN UNNEST(@keys)""",
+        },
+    },
+}
+
+
+def _script(name, derived):
+    key = derived["key"]
+    full = derived["query"].format(dataset=DATASET, where="")
+    touched = derived["query"].format(dataset=DATASET, where=derived["where"])
+    return f"""
+    DECLARE _keys ARRAY<INT64> DEFAULT @keys;
+
+    CREATE TABLE IF NOT EXISTS {DATASET}.{name} AS
+    {full};
+
+    BEGIN TRANSACTION;
+    DELETE FROM {DATASET}.{name}
+    WHERE {key} IN UNNEST(_keys);
+    INSERT INTO {DATASET}.{name}
+    {touched};
+    COMMIT TRANSACTION;"""
+
+
+def is_source(table):
+    return any(table in derived["sources"] for derived in DERIVED.values())
+
+
+def require_bigquery():
+    if BQ_CLIENT is None:
+        raise ValueError(f"Derived tables require SINK=bigquery, got {SINK_BACKEND}")
+
+
+def _query(query, keys):
+    return BQ_CLIENT.query(
+        query,
+        job_config=bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ArrayQueryParameter("keys", "INT64", keys),
+            ]
+        ),
+    ).result()
+
+
+def _batches(keys):
+    keys = sorted(set(keys))
+    return [keys[i : i + DERIVE_BATCH] for i in range(0, len(keys), DERIVE_BATCH)]
+
+
+def resolve(table, keys):
+    # Map source keys to derived keys, before the source rows change or go away
+    require_bigquery()
+    resolved = {}
+    for name, derived in DERIVED.items():
+        if table in derived["sources"]:
+            query = f"""
+            SELECT ARRAY_AGG(DISTINCT _key IGNORE NULLS) AS keys
+            FROM ({derived["sources"][table].format(dataset=DATASET)})"""
+            resolved[name] = set()
+            for batch in _batches(keys):
+                rows = _query(query, batch)
+                resolved[name].update(
+                    [dict(row.items()) for row in rows][0]["keys"] or []
+                )
+    return resolved
+
+
+def refresh(resolved):
+    for name, keys in resolved.items():
+        for batch in _batches(keys):
+            _query(_script(name, DERIVED[name]), batch)
+    return list(resolved)
+
+
+def derive(table, keys):
+    return refresh(resolve(table, keys))
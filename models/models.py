@@ -1,11 +1,19 @@
 from abc import ABCMeta, abstractmethod
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 import importlib
+import multiprocessing
+import os
+import time
 
 import requests
-from google.cloud import bigquery
 
-from configs import BQ_CLIENT, DATASET, TIMESTAMP_FORMAT
+from configs import RUNS_TABLE, TIMESTAMP_FORMAT
+from components.cassette import Cassette
+from components.getter import IdGetter, select_getter
+from components.idset import IdSet
+from components.sink import SINK, BigQuerySink
+from models import derived
 
 transform_ts = (
     lambda x: datetime.strptime(x, TIMESTAMP_FORMAT).isoformat(timespec="seconds")
@@ -13,6 +21,16 @@ transform_ts = (
     else None
 )
 
+PARALLEL_TRANSFORM_ROWS = 20000
+
+RUNS_SCHEMA = [
+    {"name": "model", "type": "STRING"},
+    {"name": "started_at", "type": "TIMESTAMP"},
+    {"name": "duration", "type": "FLOAT"},
+    {"name": "num_processed", "type": "INTEGER"},
+    {"name": "latest", "type": "TIMESTAMP"},
+]
+
 TABLES = {
     "simple": [
         "LinkedinAccounts",
@@ -33,6 +51,15 @@ TABLES = {
 
 
 class Liaufa(metaclass=ABCMeta):
+    # Set to a Getter class to pin the fetch strategy instead of selecting it
+    getter = None
+    # Set on append-only tables: stored rows are never fetched again
+    keyset_key = None
+    refresh_interval = 60
+    chunk_size = 50000
+    # Set to None on models whose _transform is too cheap to pay for a pool
+    parallel_transform_rows = PARALLEL_TRANSFORM_ROWS
+
     @staticmethod
     def factory(table):
         try:
@@ -67,52 +94,217 @@ class Liaufa(metaclass=ABCMeta):
     def p_key(self):
         pass
 
-    def __init__(self):
-        self._getter = self.getter(self)
-
     @abstractmethod
     def _transform(self, rows):
         pass
 
+    def _dedup(self, rows):
+        incre_key = getattr(self, "incre_key", None)
+        latest = {}
+        for row in rows:
+            key = tuple(row[k] for k in self.p_key)
+            if (
+                not incre_key
+                or key not in latest
+                or (row.get(incre_key) or "") >= (latest[key].get(incre_key) or "")
+            ):
+                latest[key] = row
+        return list(latest.values())
+
     def _load(self, rows):
-        output_rows = (
-            BQ_CLIENT.load_table_from_json(
-                rows,
-                f"{DATASET}.{self.table}",
-                job_config=bigquery.LoadJobConfig(
-                    create_disposition="CREATE_IF_NEEDED",
-                    write_disposition="WRITE_APPEND",
-                    schema=self.schema,
-                ),
+        return SINK.append(self.table, rows, self.schema)
+
+    def _update(self):
+        SINK.dedup(self.table, self.p_key, getattr(self, "incre_key", None))
+
+    def _dry_run(self, cassette):
+        # Replayed responses are stale, never write them into the live dataset
+        return cassette == "replay" and isinstance(SINK, BigQuerySink)
+
+    def _changed(self):
+        # Derived tables only need the keys of rows that differ from the stored
+        # ones, judged before this run loads anything
+        key = self.p_key[0]
+        if any(field["name"] == "updated" for field in self.schema):
+            since = SINK.watermark(self.table, "updated")
+            return lambda row: (
+                not since
+                or not row.get("updated")
+                or datetime.fromisoformat(row["updated"]) > since
+            )
+        stored = SINK.ids(self.table, key)
+        return lambda row: row[key] not in stored
+
+    def _session(self, cassette=None, speed=1.0):
+        if cassette:
+            return Cassette(self.table, cassette, speed)
+        return requests.Session()
+
+    def _log_run(self, started_at, duration, num_processed, latest):
+        SINK.append(
+            RUNS_TABLE,
+            [
+                {
+                    "model": self.__class__.__name__,
+                    "started_at": started_at.isoformat(timespec="seconds"),
+                    "duration": duration,
+                    "num_processed": num_processed,
+                    "latest": latest,
+                }
+            ],
+            RUNS_SCHEMA,
+        ).result()
+
+    def _transform_parallel(self, rows):
+        workers = os.cpu_count() or 1
+        threshold = self.parallel_transform_rows
+        if not threshold or workers == 1 or len(rows) < threshold:
+            return self._transform(rows)
+        if not self._executor:
+            # KeysetGetter threads may be mid-request, so never fork this process
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                "forkserver" if "forkserver" in methods else "spawn"
+            )
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context,
             )
-            .result()
-            .output_rows
+        size = -(-len(rows) // workers)
+        chunks = [rows[i : i + size] for i in range(0, len(rows), size)]
+        slices = self._executor.map(
+            _transform_chunk,
+            [type(self)] * len(chunks),
+            chunks,
         )
-        self._update()
-        return output_rows
+        return [row for i in slices for row in i]
 
-    def _update(self):
+    def _flush(self, rows, stats):
         incre_key = getattr(self, "incre_key", None)
-        incre_key = f"ORDER BY {incre_key} DESC" if incre_key else ""
-        query = f"""
-        CREATE OR REPLACE TABLE {DATASET}.{self.table} AS
-        SELECT * EXCEPT (row_num)
-        FROM (
-            SELECT
-                *,
-                ROW_NUMBER() OVER (PARTITION BY {','.join(self.p_key)} {incre_key}) AS row_num
-            FROM {DATASET}.{self.table}
-        ) WHERE row_num = 1"""
-        BQ_CLIENT.query(query).result()
-
-    def run(self):
-        with requests.Session() as session:
-            rows = self._getter.get(session)
+        key = self.p_key[0]
+        flushed = stats["flushed"]
+        # Drift can repeat a key in a later chunk, only load it again if newer
+        deduped = [
+            row
+            for row in self._dedup(rows)
+            if row[key] not in flushed
+            or (incre_key and (row.get(incre_key) or "") > flushed[row[key]])
+        ]
+        for row in deduped:
+            if incre_key:
+                flushed[row[key]] = row.get(incre_key) or ""
+            else:
+                flushed.add(row[key])
+        stats["duplicates"] += len(rows) - len(deduped)
+        stats["num_processed"] += len(deduped)
+        if not deduped:
+            return None
+        rows = self._transform_parallel(deduped)
+        if stats["changed"]:
+            stats["keys"].extend(row[key] for row in rows if stats["changed"](row))
+        stats["latest"] = (
+            max(
+                [stats["latest"] or ""]
+                + [row["updated"] for row in rows if row.get("updated")]
+            )
+            or None
+        )
+        if stats["dry_run"]:
+            return None
+        return self._load(rows)
+
+    def tombstone(self, cassette=None, speed=1.0, derive=False):
+        if derive:
+            derived.require_bigquery()
+        # Snapshot first so rows loaded by a concurrent run during the scan
+        # are never mistaken for tombstones
+        stored = SINK.ids(self.table, self.p_key[0])
+        with self._session(cassette, speed) as session:
+            getter = IdGetter(self)
+            live = getter.get(session)
+        response = {
+            "table": self.table,
+            "live": len(live),
+            "tombstones": 0,
+        }
+        # Rows skipped by a shifting page would be deleted by mistake
+        if not getter.complete:
+            response["skipped"] = "ids changed during scan"
+            return response
+        missing = [i for i in stored if i not in live]
+        response["stored"] = len(stored)
+        response["tombstones"] = len(missing)
+        if self._dry_run(cassette):
+            response["dry_run"] = True
+        elif missing:
+            resolved = derived.resolve(self.table, missing) if derive else {}
+            SINK.delete(self.table, self.p_key[0], missing)
+            if derive:
+                response["derived"] = derived.refresh(resolved)
+        return response
+
+    def run(self, cassette=None, speed=1.0, derive=False):
+        if derive:
+            derived.require_bigquery()
+        changed = self._changed() if derive else None
+        started_at = datetime.utcnow()
+        start = time.perf_counter()
+        stats = {
+            "num_processed": 0,
+            "duplicates": 0,
+            "keys": [],
+            "changed": changed,
+            "latest": None,
+            "flushed": {} if getattr(self, "incre_key", None) else IdSet(),
+            "dry_run": self._dry_run(cassette),
+        }
+        jobs = []
+        self._executor = None
+        try:
+            with self._session(cassette, speed) as session:
+                getter, reason = select_getter(self, session)
+                self._getter = getter(self)
+                rows = []
+                # Load jobs run in BigQuery while the next chunk is being fetched
+                for page in self._getter.pages(session):
+                    rows.extend(page)
+                    if len(rows) >= self.chunk_size:
+                        jobs.append(self._flush(rows, stats))
+                        rows = []
+                if rows:
+                    jobs.append(self._flush(rows, stats))
+            jobs = [job for job in jobs if job]
+        finally:
+            if self._executor:
+                self._executor.shutdown()
         response = {
             "table": self.table,
-            "num_processed": len(rows),
+            "num_processed": stats["num_processed"],
+            "duplicates": stats["duplicates"],
+            "drift": self._getter.drift,
+            "getter": getter.__name__,
+            "reason": reason,
         }
-        if len(rows) > 0:
-            rows = self._transform(rows)
-            response["output_rows"] = self._load(rows)
+        if stats["dry_run"]:
+            response["dry_run"] = True
+        if jobs:
+            response["output_rows"] = sum(job.result().output_rows for job in jobs)
+            response["chunks"] = len(jobs)
+            self._update()
+            if derive:
+                response["derived"] = derived.derive(
+                    self.table,
+                    list(set(stats["keys"])),
+                )
+        if cassette != "replay":
+            self._log_run(
+                started_at,
+                time.perf_counter() - start,
+                stats["num_processed"],
+                stats["latest"],
+            )
         return response
+
+
+def _transform_chunk(model, rows):
+    return model()._transform(rows)
@@ -1,30 +1,100 @@
 import os
 import json
 import uuid
+from datetime import datetime, timedelta
+from functools import lru_cache
 
+from google.api_core.exceptions import NotFound
 from google.cloud import tasks_v2
+from google.protobuf import timestamp_pb2
 
-from models.models import TABLES
+from configs import BQ_CLIENT, DATASET, RUNS_TABLE, SINK_BACKEND
+from models.models import TABLES, Liaufa
+from models import derived
 
-TASKS_CLIENT = tasks_v2.CloudTasksClient()
 CLOUD_TASKS_PATH = {
     "project": os.getenv("PROJECT_ID"),
     "location": os.getenv("REGION"),
     "queue": "liaufa",
 }
-PARENT = TASKS_CLIENT.queue_path(**CLOUD_TASKS_PATH)
+PARENT = tasks_v2.CloudTasksClient.queue_path(**CLOUD_TASKS_PATH)
 
+# Tables that stop changing back off up to MAX_BACKOFF x refresh_interval
+MAX_BACKOFF = 8
+GRACE = timedelta(minutes=5)
+STAGGER = timedelta(seconds=30)
 
-def create_task():
-    payloads = [
-        {
-            "table": table,
-        }
-        for table in [table for i in TABLES.values() for table in i]
-    ]
+
+@lru_cache(maxsize=None)
+def get_tasks_client():
+    # Built on first use so importing main needs no GCP credentials
+    return tasks_v2.CloudTasksClient()
+
+
+def get_stats():
+    if BQ_CLIENT is None:
+        raise ValueError(f"Scheduling requires SINK=bigquery, got {SINK_BACKEND}")
+    query = f"""
+    WITH runs AS (
+        SELECT
+            model,
+            started_at,
+            duration,
+            -- Tables without an updated column fall back to row count changes
+            IF(
+                latest IS NULL,
+                num_processed != LAG(num_processed) OVER w,
+                latest > LAG(latest) OVER w
+            ) AS changed
+        FROM {DATASET}.{RUNS_TABLE}
+        WHERE started_at > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 7 DAY)
+        WINDOW w AS (PARTITION BY model ORDER BY started_at)
+    )
+    SELECT
+        model,
+        MAX(started_at) AS last_run,
+        AVG(duration) AS cost,
+        AVG(CAST(changed AS INT64)) AS change_rate
+    FROM runs
+    GROUP BY model"""
+    try:
+        rows = BQ_CLIENT.query(query).result()
+    except NotFound:
+        return {}
+    return {row["model"]: dict(row.items()) for row in rows}
+
+
+def schedule(tables, stats, now):
+    due = []
+    for table in tables:
+        stat = stats.get(table)
+        if not stat:
+            due.append((float("inf"), 0, table))
+            continue
+        change_rate = stat["change_rate"]
+        change_rate = 1 if change_rate is None else change_rate
+        backoff = 1 / max(change_rate, 1 / MAX_BACKOFF)
+        refresh_interval = Liaufa.factory(table).refresh_interval
+        interval = timedelta(minutes=refresh_interval * backoff)
+        elapsed = now - stat["last_run"].replace(tzinfo=None)
+        if elapsed + GRACE >= interval:
+            due.append((elapsed / interval, stat["cost"] or 0, table))
+    return [table for _, _, table in sorted(due, key=lambda x: (-x[0], x[1]))]
+
+
+def create_task(force=False):
+    now = datetime.utcnow()
+    tables = [table for i in TABLES.values() for table in i]
+    if not force:
+        tables = schedule(tables, get_stats(), now)
+    payloads = [{"table": table} for table in tables]
+    for payload in payloads:
+        # Keep derived tables current whenever one of their sources loads
+        if derived.is_source(Liaufa.factory(payload["table"]).table):
+            payload["derive"] = True
     tasks = [
         {
-            "name": TASKS_CLIENT.task_path(
+            "name": tasks_v2.CloudTasksClient.task_path(
                 **CLOUD_TASKS_PATH,
                 task=f"{payload['table']}-{uuid.uuid4()}",
             ),
@@ -39,11 +109,12 @@ def create_task():
                 },
                 "body": json.dumps(payload).encode(),
             },
+            "schedule_time": _timestamp(now + STAGGER * i),
         }
-        for payload in payloads
+        for i, payload in enumerate(payloads)
     ]
     responses = [
-        TASKS_CLIENT.create_task(
+        get_tasks_client().create_task(
             request={
                 "parent": PARENT,
                 "task": task,
@@ -53,4 +124,11 @@ def create_task():
     ]
     return {
         "tasks": len(responses),
+        "tables": tables,
     }
+
+
+def _timestamp(dt):
+    ts = timestamp_pb2.Timestamp()
+    ts.FromDatetime(dt)
+    return ts
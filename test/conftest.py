@@ -0,0 +1,5 @@
+import os
+
+# Runs before any test module imports configs, so collection needs no GCP
+# credentials. Export SINK=bigquery to run the live tests against BigQuery.
+os.environ.setdefault("SINK", "sqlite")
@@ -0,0 +1,346 @@
+import pytest
+from google.api_core.exceptions import NotFound
+
+from components.idset import IdSet
+from components.getter import (
+    AsyncGetter,
+    KeysetGetter,
+    ReverseGetter,
+    SimpleGetter,
+    select_getter,
+)
+from components.sink import BigQuerySink, SQLiteSink, get_sink
+from models import derived
+from models.LinkedinContacts import LinkedinContacts
+from models.LinkedinContactsTags import LinkedinContactsTags
+from models.LinkedinSimpleMessenger import LinkedinSimpleMessenger
+from models.Tags import Tags
+
+
+class Response:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Session:
+    def __init__(self, ids, page_size, mutate=None, filters=False, updated=None):
+        self.ids = ids
+        self.page_size = page_size
+        self.mutate = mutate or {}
+        self.filters = filters
+        self.updated = updated
+        self.calls = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def post(self, **kwargs):
+        return Response(200, {"access": "token"})
+
+    def get(self, url, params, headers):
+        self.calls += 1
+        if self.calls in self.mutate:
+            self.mutate[self.calls](self.ids)
+        page, size = params["page"], params.get("page_size", self.page_size)
+        ids = self.ids
+        if self.filters:
+            ids = [i for i in ids if i > params.get("id__gt", -1)]
+            ids = [i for i in ids if i <= params.get("id__lte", i)]
+        if params.get("ordering") == "-id":
+            ids = ids[::-1]
+        chunk = ids[(page - 1) * size : page * size]
+        if not chunk:
+            return Response(404)
+        return Response(
+            200,
+            {
+                "count": len(ids),
+                "results": [
+                    {"id": i, **({"updated": self.updated(i)} if self.updated else {})}
+                    for i in chunk
+                ],
+            },
+        )
+
+
+@pytest.fixture
+def sink(tmp_path, monkeypatch):
+    sink = SQLiteSink(str(tmp_path / "liaufa.db"))
+    monkeypatch.setattr("models.models.SINK", sink)
+    monkeypatch.setattr("components.getter.SINK", sink)
+    return sink
+
+
+class Model:
+    endpoint = "fake/"
+    page_size = 10
+    p_key = ["id"]
+    keyset_key = "id"
+    table = "fake"
+
+
+def test_idset():
+    ids = IdSet([5, 1, 1000, 5])
+    assert len(ids) == 3
+    assert list(ids) == [1, 5, 1000]
+    assert 1000 in ids
+    assert 7 not in ids
+    assert 10 ** 6 not in ids
+
+
+def test_track_refetches_shifted_neighbor():
+    # Deleting a row before page 3 is fetched slides id 21 onto page 2
+    session = Session(list(range(1, 41)), 10, {3: lambda ids: ids.remove(1)})
+    getter = SimpleGetter(Model())
+    rows = getter.get(session)
+    ids = [row["id"] for row in rows]
+    assert sorted(ids) == list(range(1, 41))
+    assert len(ids) == len(set(ids))
+    assert getter.drift == 1
+
+
+def test_track_refetches_before_missing_last_page():
+    # Deleting a row before page 4 removes that page and slides id 31 onto page 3
+    session = Session(list(range(1, 32)), 10, {4: lambda ids: ids.remove(1)})
+    getter = SimpleGetter(Model())
+    rows = getter.get(session)
+    assert sorted(row["id"] for row in rows) == list(range(1, 32))
+    assert getter.drift == 1
+
+
+def test_track_without_drift():
+    session = Session(list(range(1, 26)), 10)
+    getter = SimpleGetter(Model())
+    rows = getter.get(session)
+    assert [row["id"] for row in rows] == list(range(1, 26))
+    assert getter.drift == 0
+
+
+def test_dedup_keeps_newest_incre_key():
+    rows = [
+        {"id": 1, "updated": "2021-01-02T00:00:00+0000"},
+        {"id": 2, "updated": "2021-01-01T00:00:00+0000"},
+        {"id": 1, "updated": "2021-01-01T00:00:00+0000"},
+        {"id": 2, "updated": "2021-01-03T00:00:00+0000"},
+    ]
+    deduped = LinkedinSimpleMessenger()._dedup(rows)
+    assert sorted((row["id"], row["updated"][:10]) for row in deduped) == [
+        (1, "2021-01-02"),
+        (2, "2021-01-03"),
+    ]
+
+
+def test_run_dedups_across_chunks(sink):
+    # Inserting a row in front before page 2 repeats id 10 in the next chunk
+    session = Session(list(range(1, 41)), 10, {3: lambda ids: ids.insert(0, 0)})
+    model = Tags()
+    model.page_size = 10
+    model.chunk_size = 10
+    model._session = lambda *args: session
+    res = model.run()
+    assert res["chunks"] > 1
+    assert res["duplicates"] == 1
+    assert res["num_processed"] == res["output_rows"] == 41
+    assert sink.count("tags") == 41
+
+
+class Client:
+    def get_table(self, table):
+        raise NotFound(table)
+
+    def load_table_from_json(self, *args, **kwargs):
+        raise AssertionError("replay wrote to BigQuery")
+
+    query = load_table_from_json
+
+
+def test_replay_never_loads_into_bigquery(monkeypatch):
+    sink = BigQuerySink(Client(), "Liaufa")
+    monkeypatch.setattr("models.models.SINK", sink)
+    monkeypatch.setattr("components.getter.SINK", sink)
+    model = Tags()
+    model._session = lambda *args: Session(list(range(1, 41)), model.page_size)
+    res = model.run(cassette="replay")
+    assert res["dry_run"]
+    assert res["num_processed"] == 40
+    assert "output_rows" not in res
+
+
+@pytest.mark.parametrize("model", [Tags, LinkedinContactsTags])
+def test_derive_sends_changed_keys(sink, monkeypatch, model):
+    # Ids 1-20 are stored and unchanged upstream, 15-30 were edited or added
+    sink.append(
+        model.table,
+        [{"id": i, "updated": "2021-01-01T00:00:00+00:00"} for i in range(1, 21)],
+        model.schema,
+    )
+    updated = lambda i: f"2021-01-0{1 + (i >= 15)}T00:00:00+0000"
+    session = Session(list(range(1, 31)), 10, updated=updated)
+    sent = []
+    monkeypatch.setattr("models.derived.require_bigquery", lambda: None)
+    monkeypatch.setattr(
+        "models.derived.derive", lambda table, keys: sent.extend(keys) or []
+    )
+    model = model()
+    model.page_size = 10
+    model._session = lambda *args: session
+    model.run(derive=True)
+    # Without an updated column only unseen ids count as changed
+    first = 15 if "updated" in [field["name"] for field in model.schema] else 21
+    assert sorted(sent) == list(range(first, 31))
+
+
+def test_derive_batches_keys(monkeypatch):
+    queries = []
+    monkeypatch.setattr("models.derived.DERIVE_BATCH", 3)
+    monkeypatch.setattr(
+        "models.derived._query", lambda query, keys: queries.append(keys)
+    )
+    assert derived.refresh({"contacts_tags": [5, 1, 2, 2, 4, 3, 6, 7]}) == [
+        "contacts_tags"
+    ]
+    assert queries == [[1, 2, 3], [4, 5, 6], [7]]
+
+
+@pytest.mark.parametrize(
+    "model,stored,count,getter",
+    [
+        (LinkedinSimpleMessenger, 10, 10 ** 6, ReverseGetter),
+        (LinkedinSimpleMessenger, 10, 10, ReverseGetter),
+        (LinkedinContacts, 10, 10, KeysetGetter),
+        (LinkedinContacts, 0, 10 ** 6, KeysetGetter),
+        (Tags, 10, 10 ** 6, ReverseGetter),
+        (Tags, 0, 10 ** 6, AsyncGetter),
+        (LinkedinContactsTags, 10, 100, SimpleGetter),
+        (LinkedinContactsTags, 0, 10 ** 6, AsyncGetter),
+        (LinkedinContactsTags, 10, 10 ** 6, SimpleGetter),
+    ],
+)
+def test_select_getter(sink, model, stored, count, getter):
+    if stored:
+        sink.append(model.table, [{"id": i} for i in range(stored)], model.schema)
+    session = Session(list(range(count)), model.page_size)
+    assert select_getter(model(), session)[0] is getter
+
+
+@pytest.mark.parametrize("filters", [True, False])
+def test_keyset_pages(sink, filters):
+    ids = list(range(1, 1000, 3))
+    session = Session(ids, 10, filters=filters)
+    rows = KeysetGetter(Model()).get(session)
+    assert [row["id"] for row in rows] == ids
+
+
+def test_keyset_streams(sink):
+    session = Session(list(range(1, 10001)), 10, filters=True)
+    pages = KeysetGetter(Model()).pages(session)
+    assert [row["id"] for row in next(pages)] == list(range(1, 11))
+    pages.close()
+    # Workers stop at their bounded queues instead of fetching every range
+    assert session.calls < 1000 // 2
+
+
+@pytest.mark.parametrize(
+    "model,cpus,parallel",
+    [
+        (LinkedinSimpleMessenger, 4, True),
+        (LinkedinSimpleMessenger, 1, False),
+        (LinkedinContactsTags, 4, False),
+    ],
+)
+def test_transform_parallel(monkeypatch, model, cpus, parallel):
+    monkeypatch.setattr("models.models.os.cpu_count", lambda: cpus)
+    model = model()
+    model._executor = None
+    rows = [{"id": i} for i in range(model.parallel_transform_rows or 20000)]
+    try:
+        assert model._transform_parallel(rows) == model._transform(rows)
+        assert bool(model._executor) is parallel
+    finally:
+        if model._executor:
+            model._executor.shutdown()
+
+
+def test_tombstone(sink, monkeypatch):
+    sink.append("tags", [{"id": i} for i in range(1, 31)], Tags.schema)
+    live = [i for i in range(1, 31) if i != 5]
+    # A concurrent run loads id 31 while the id scan is in flight
+    session = Session(
+        live,
+        10,
+        {1: lambda ids: sink.append("tags", [{"id": 31}], Tags.schema)},
+    )
+    calls = []
+    monkeypatch.setattr("models.derived.require_bigquery", lambda: None)
+    monkeypatch.setattr(
+        "models.derived.resolve",
+        lambda table, keys: calls.append(("resolve", 5 in sink.ids(table, "id")))
+        or {"contacts_tags": keys},
+    )
+    monkeypatch.setattr(
+        "models.derived.refresh",
+        lambda resolved: calls.append(("refresh", resolved)) or list(resolved),
+    )
+    model = Tags()
+    model._session = lambda *args: session
+    res = model.tombstone(derive=True)
+    assert res["tombstones"] == 1
+    assert res["derived"] == ["contacts_tags"]
+    assert calls == [("resolve", True), ("refresh", {"contacts_tags": [5]})]
+    assert list(sink.ids("tags", "id")) == live + [31]
+    # One id-only page plus the terminating 404
+    assert session.calls == 2
+
+
+def test_sqlite_sink(sink):
+    schema = LinkedinSimpleMessenger.schema
+    rows = [
+        {"id": 1, "contact": {"id": 7}, "updated": "2021-01-01T00:00:00+00:00"},
+        {"id": 2, "contact": None, "updated": "2021-01-02T00:00:00+00:00"},
+        {"id": 1, "contact": {"id": 8}, "updated": "2021-01-03T00:00:00+00:00"},
+    ]
+    table = LinkedinSimpleMessenger.table
+    assert sink.count(table) == 0
+    assert sink.watermark(table, "updated") is None
+    assert sink.append(table, rows, schema).result().output_rows == 3
+    sink.dedup(table, ["id"], "updated")
+    assert sink.count(table) == 2
+    assert list(sink.ids(table, "id")) == [1, 2]
+    assert sink.conn.execute(
+        f"SELECT contact FROM {table} WHERE id = 1"
+    ).fetchall() == [('{"id": 8}',)]
+    assert sink.watermark(table, "updated").isoformat() == "2021-01-03T00:00:00+00:00"
+    sink.delete(table, "id", [2])
+    assert list(sink.ids(table, "id")) == [1]
+
+
+def test_get_sink(tmp_path):
+    with pytest.raises(ValueError):
+        get_sink("duckdb")
+    path = tmp_path / "lazy.db"
+    sink = SQLiteSink(str(path))
+    assert not path.exists()
+    assert sink.count("tags") == 0
+    assert path.exists()
+
+
+def test_derive_requires_bigquery(sink, monkeypatch):
+    monkeypatch.setattr("models.derived.BQ_CLIENT", None)
+    with pytest.raises(ValueError):
+        Tags().run(derive=True)
@@ -1,8 +1,11 @@
+from datetime import datetime, timedelta
+
 import pytest
 from unittest.mock import Mock
 
 from main import main
 from models.models import TABLES
+from tasks import schedule
 
 
 def process(data):
@@ -13,6 +16,7 @@ def process(data):
 
 class TestPipelines:
     def assert_pipelines(self, res):
+        assert res["getter"] and res["reason"]
         assert res["num_processed"] >= 0
         if res["num_processed"] > 0:
             assert res["num_processed"] == res["output_rows"]
@@ -55,6 +59,104 @@ class TestPipelines:
 def test_tasks():
     data = {
         "tasks": "liaufa",
+        "force": True,
     }
     res = process(data)
     assert res["tasks"] > 0
+
+
+def test_schedule():
+    now = datetime(2021, 1, 1, 12)
+
+    def stat(minutes_ago, cost, change_rate):
+        return {
+            "last_run": now - timedelta(minutes=minutes_ago),
+            "cost": cost,
+            "change_rate": change_rate,
+        }
+
+    stats = {
+        # refresh_interval 15, 4x overdue
+        "LinkedinSimpleMessenger": stat(60, 50, 1),
+        # refresh_interval 30, 4x overdue but cheaper
+        "LinkedinContacts": stat(120, 10, 1),
+        # refresh_interval 60, 1.5x overdue
+        "LinkedinCounts": stat(90, 1, 1),
+        # refresh_interval 360, not due yet
+        "Tags": stat(30, 1, 1),
+        # refresh_interval 360, due but never changes so backed off 8x
+        "Companies": stat(720, 1, 0),
+        # No changes observed yet, base interval applies
+        "LinkedinAccounts": stat(400, 1, None),
+    }
+    tables = list(stats) + ["CampaignContacts"]
+    assert schedule(tables, stats, now) == [
+        "CampaignContacts",
+        "LinkedinContacts",
+        "LinkedinSimpleMessenger",
+        "LinkedinCounts",
+        "LinkedinAccounts",
+    ]
+
+
+@pytest.mark.parametrize(
+    "mode",
+    ["cpu", "alloc"],
+)
+def test_profile(mode):
+    data = {
+        "table": "Tags",
+        "profile": mode,
+    }
+    res = process(data)
+    assert res["num_processed"] >= 0
+    with open(res["profile"]) as f:
+        assert f.read()
+
+
+@pytest.mark.parametrize(
+    "table",
+    TABLES["simple"][-1:] + TABLES["reverse"],
+)
+def test_cassette(table):
+    recorded = process(
+        {
+            "table": table,
+            "cassette": "record",
+        }
+    )
+    replayed = process(
+        {
+            "table": table,
+            "cassette": "replay",
+            "speed": 0,
+        }
+    )
+    assert replayed["num_processed"] == recorded["num_processed"]
+
+
+@pytest.mark.parametrize(
+    "table",
+    ["Tags", "CampaignContacts"],
+)
+def test_derive(table):
+    data = {
+        "table": table,
+        "derive": True,
+    }
+    res = process(data)
+    if res["num_processed"] > 0:
+        assert "derived" in res
+
+
+@pytest.mark.parametrize(
+    "table",
+    ["Tags", "LinkedinContactsTags"],
+)
+def test_tombstone(table):
+    data = {
+        "table": table,
+        "tombstone": True,
+    }
+    res = process(data)
+    assert res["tombstones"] >= 0